@@ -2,6 +2,7 @@
 """
 Raspberry‑Pi sender for FP‑16 bit‑plane demo.
 • Simulates multi‑sensor data (temperature & humidity by default)
+• Keeps each batch sensor‑major (SoA): one contiguous FP16 run per sensor
 • Splits every FP16 value into 16 bit‑planes at the *bit* level
   – Packs bits densely with np.packbits (8 bits per byte)
 • For each plane: if packed size ≥ 4 KB → chop into 4 KB blocks,
@@ -11,26 +12,47 @@ Raspberry‑Pi sender for FP‑16 bit‑plane demo.
 Header includes:
   planes, per‑segment block sizes, per‑plane num_bits, compression stats
 """
-import socket, struct, json, threading, time, collections, random, math
-import numpy as np, lz4.frame as lz4, zstandard as zstd
+import socket, struct, json, threading, time, collections
+import concurrent.futures, functools, itertools, secrets
+import numpy as np, lz4.frame as lz4, lz4.block as lz4b, zstandard as zstd, msgpack
+try:
+    from numba import njit
+except ImportError:                 # numba is optional; NumPy path below
+    njit = None
 
 # ─── parameters ─────────────────────────────────────────────
 SAMPLE_HZ      = 10
 BATCH_SAMPLES  = 256
 CACHE_BATCHES  = 120
-COMP_ALGO      = "lz4"           # or "zstd"
+COMP_ALGO      = "lz4"           # "lz4" (frame), "lz4b" (raw block) or "zstd"
 HOST, PORT     = "", 50007
 BLOCK_BYTES    = 4096            # 4 KB
+COMP_WORKERS   = 4               # one per Pi core
+DICT_BYTES     = 512             # zstd per‑plane dict (packed planes are 64 B)
+DICT_EVERY     = 8               # retrain zstd dictionaries every N batches
+DICT_MIN_CORPUS= 10*DICT_BYTES    # train only on a corpus this large
+# compressed block sizes go on the wire as uint16 while even an incompressible
+# block (≤ BLOCK_BYTES plus codec bound overhead) stays below 64 KB
+SIZE_DTYPE     = "<u2" if BLOCK_BYTES <= 0xF000 else "<u4"
 # ─────────────────────────────────────────────────────────────
 
 # Simulated sensors
 SENSORS = ["temperature", "humidity"]
 NUM_SENSORS = len(SENSORS)
 
-def synth_temp(t): return 25.0 + 2.0*math.sin(t/120) + random.uniform(-.05,.05)
-def synth_hum(t):  return 50.0 + 5.0*math.cos(t/150) + random.uniform(-.2,.2)
+rng = np.random.default_rng()
+def synth_temp(t): return 25.0 + 2.0*np.sin(t/120) + rng.uniform(-.05,.05,t.shape)
+def synth_hum(t):  return 50.0 + 5.0*np.cos(t/150) + rng.uniform(-.2,.2,t.shape)
 SIM_FUN = {"temperature": synth_temp, "humidity": synth_hum}
 
+def synth_batch(ts, out=None):
+    """Vectorised simulation: row per sensor, column per timestamp (FP16)."""
+    if out is None:
+        out = np.empty((NUM_SENSORS, len(ts)), np.float16)
+    for i, name in enumerate(SENSORS):
+        out[i] = SIM_FUN[name](ts)
+    return out
+
 # Bit‑plane policy: always send sign+exponent, then top mantissa bits
 MANDATORY = {15,14,13,12,11,10}
 def choose_planes(requested:int):
@@ -38,71 +60,228 @@ def choose_planes(requested:int):
     mant  = list(range(9, 9-extra, -1))
     return sorted(MANDATORY.union(mant))
 
+# ---------- bit‑plane packing -------------------------------------------
+if njit is not None:
+    # serial on purpose: a 64‑byte batch is done before parallel workers start
+    @njit('void(uint16[::1], uint8[:,::1])', cache=True)
+    def pack_planes_fp16(u16, out):
+        """Fused shift+mask+pack: out[b, j] holds bit b of values 8j..8j+7."""
+        n = u16.size
+        for j in range(out.shape[1]):
+            base = 8*j
+            for b in range(16):
+                acc = 0
+                for k in range(min(8, n-base)):
+                    acc |= ((u16[base+k] >> b) & 1) << (7-k)
+                out[b, j] = acc
+else:
+    pack_planes_fp16 = None
+
+def pack_planes(u16, out=None):
+    """Return (16, ceil(n/8)) uint8 array; row b = bit‑plane b densely packed."""
+    if out is None:
+        out = np.empty((16, (u16.size+7)//8), np.uint8)
+    if pack_planes_fp16 is not None:
+        pack_planes_fp16(u16, out)
+    else:
+        # one broadcast; rows are plane‑major so each plane stays contiguous
+        bits = ((u16 >> np.arange(16,dtype=np.uint16)[:,None]) & 1).astype(np.uint8)
+        out[:] = np.packbits(bits, axis=1)
+    return out
+
 # ---------- compression helpers -----------------------------------------
+# lz4/zstd release the GIL, so multi‑block planes compress in parallel on a
+# thread pool (see compress_and_store for when it is used).
+# ZstdCompressor is stateful → one per worker thread (and per dictionary).
+POOL = concurrent.futures.ThreadPoolExecutor(max_workers=COMP_WORKERS)
+_tls = threading.local()
+
+def zstd_compress(a, zd=None):
+    """Compress with this thread's ZstdCompressor for dictionary zd (or none).
+    The dict id travels in the header, so frames don't repeat it."""
+    ccs = getattr(_tls, "cc", None)
+    if ccs is None:
+        ccs = _tls.cc = {}
+    key = zd.dict_id() if zd is not None else 0
+    cc  = ccs.get(key)
+    if cc is None:
+        if len(ccs) > 32: ccs.clear()          # drop compressors of retired dicts
+        cc = ccs[key] = zstd.ZstdCompressor(level=3, dict_data=zd, write_dict_id=False)
+    return cc.compress(a)
+
 def compress_blocks(packed: np.ndarray, comp):
-    """Return (sizes, blobs) where each blob ≤ BLOCK_BYTES."""
+    """Return (sizes, blobs) where each blob ≤ BLOCK_BYTES.
+    Blocks are memoryview slices of packed – no copy before comp."""
     if packed.nbytes == 0:
         return [], []
+    mv = memoryview(packed)
+    if packed.nbytes <= BLOCK_BYTES:            # common case: single block
+        blob = comp(mv)
+        return [len(blob)], [blob]
     sizes, blobs = [], []
     for off in range(0, len(packed), BLOCK_BYTES):
-        blob = comp(packed[off:off+BLOCK_BYTES].tobytes())
+        blob = comp(mv[off:off+BLOCK_BYTES])
         blobs.append(blob); sizes.append(len(blob))
     return sizes, blobs
 
+# ---------- zstd per‑plane dictionaries ---------------------------------
+# Sign/exponent planes are near‑constant streams; a dictionary trained on
+# recent packed planes lets zstd model them far better than a cold start.
+dict_lock    = threading.Lock()
+dict_samples = [collections.deque(maxlen=CACHE_BATCHES) for _ in range(16)]
+plane_dicts  = [None]*16                     # current ZstdCompressionDict per plane
+batches_seen = 0
+# Retrained dicts can come out with the same content‑derived id, so every
+# dict gets a fresh id (above zstd's reserved 0‑32767); SESSION tells
+# clients when this process restarted and their cached ids are void.
+dict_ids = itertools.count(1<<15)
+SESSION  = secrets.randbits(31)
+
+def update_dicts(planes):
+    """Keep packed planes as training samples; retrain every DICT_EVERY batches."""
+    global batches_seen
+    with dict_lock:
+        for b in range(16):
+            dict_samples[b].append(planes[b].tobytes())
+        batches_seen += 1
+        if batches_seen % DICT_EVERY:
+            return
+        samples = [list(d) for d in dict_samples]
+    plain = zstd.ZstdCompressor(level=3)
+    for b in range(16):
+        # train on older batches, judge on the newest DICT_EVERY
+        train, held = samples[b][:-DICT_EVERY], samples[b][-DICT_EVERY:]
+        if sum(map(len, train)) < DICT_MIN_CORPUS:
+            continue
+        try:
+            zd = zstd.train_dictionary(DICT_BYTES, train, dict_id=next(dict_ids))
+        except zstd.ZstdError:
+            continue                         # degenerate samples; keep old
+        cc    = zstd.ZstdCompressor(level=3, dict_data=zd, write_dict_id=False)
+        saved = sum(len(plain.compress(x)) - len(cc.compress(x)) for x in held)
+        with dict_lock:                      # worth it only if it pays for shipping
+            plane_dicts[b] = zd if saved > len(zd.as_bytes()) else None
+
 # ---------- batch cache structure ---------------------------------------
+# plane_dicts holds the ZstdCompressionDict (or None) each plane was
+# compressed with, so dictionaries live exactly as long as batches use them.
+# const0/const1 are bitmasks of planes that are all‑0 / all‑1 in the batch;
+# those planes carry no blocks at all.  plane_cbytes / plane_size_bytes are
+# per‑plane totals and SIZE_DTYPE block‑size blobs, computed once at store time.
 Batch = collections.namedtuple(
     "Batch",
-    "start_ts end_ts samples plane_blocks plane_block_sizes comp_time_ms"
+    "start_ts end_ts samples plane_blocks plane_block_sizes comp_time_ms plane_dicts "
+    "const0 const1 plane_cbytes plane_size_bytes"
 )
 cache_lock = threading.Lock()
 batch_cache = collections.deque(maxlen=CACHE_BATCHES)
 
 # ---------- producer thread ---------------------------------------------
 def producer():
-    buf = np.empty((BATCH_SAMPLES, NUM_SENSORS), np.float16)
-    idx = 0
+    # Double buffer: compress_and_store consumes one slot in its own thread
+    # while the other fills.  It must be done with its slot before that slot
+    # comes round again (BATCH_SAMPLES/SAMPLE_HZ = 25.6 s — easily met).
+    bufs   = [np.empty((NUM_SENSORS, BATCH_SAMPLES), np.float16) for _ in range(2)]
+    outs   = [np.empty((16, (BATCH_SAMPLES*NUM_SENSORS+7)//8), np.uint8) for _ in range(2)]
+    ts     = np.empty(BATCH_SAMPLES)       # sample times of the current batch
+    steps  = np.arange(BATCH_SAMPLES)/SAMPLE_HZ
+    period = BATCH_SAMPLES/SAMPLE_HZ
+    active = 0
+    # one sleep per batch against a drift‑free monotonic deadline, instead of
+    # one sleep per sample
+    deadline = time.monotonic()
     while True:
-        t = time.time()
-        for i, name in enumerate(SENSORS):
-            buf[idx,i] = np.float16(SIM_FUN[name](t))
-        idx += 1
-        if idx == BATCH_SAMPLES:
-            compress_and_store(buf.copy())
-            idx = 0
-        time.sleep(1/SAMPLE_HZ)
+        t_start   = time.time()
+        deadline += period
+        wait = deadline - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        np.add(t_start, steps, out=ts)
+        synth_batch(ts, bufs[active])
+        threading.Thread(target=compress_and_store,
+                         args=(bufs[active], outs[active]), daemon=True).start()
+        active ^= 1
 
 # ---------- compress one batch ------------------------------------------
-def compress_and_store(batch_fp16):
+def compress_and_store(batch_fp16, planes_out=None):
     t0 = time.time()
-    u16 = batch_fp16.flatten().view(np.uint16)
-    n_vals = u16.size
+    u16 = batch_fp16.ravel().view(np.uint16)       # no copy for contiguous buf
 
-    # 16 bit‑planes densely packed
-    planes_packed = []
-    for b in range(16):
-        bits  = ((u16 >> b) & 1).astype(np.uint8)
-        planes_packed.append((np.packbits(bits), n_vals))  # (bytes, num_bits)
+    # 16 bit‑planes densely packed (row b = bit b of every value)
+    planes = pack_planes(u16, planes_out)
+
+    # constant planes (sign, top exponent bits) skip the codec entirely
+    const1 = int(np.bitwise_and.reduce(u16))
+    const0 = ~int(np.bitwise_or.reduce(u16)) & 0xFFFF
+    coded  = [b for b in range(16) if not (const0|const1)>>b & 1]
 
-    comp = (lambda a: lz4.compress(a,0)) if COMP_ALGO=="lz4" else zstd.ZstdCompressor(level=3).compress
+    if COMP_ALGO=="lz4":
+        dicts = [None]*16
+        comps = [lambda a: lz4.compress(a,0)]*16
+    elif COMP_ALGO=="lz4b":
+        # raw blocks: no frame header/end mark; the receiver derives each
+        # block's uncompressed size from plane_num_bits and block_bytes
+        dicts = [None]*16
+        comps = [lambda a: lz4b.compress(a,mode="fast",acceleration=1,store_size=False)]*16
+    else:
+        with dict_lock:
+            dicts = list(plane_dicts)
+        dicts = [zd if b in coded else None for b, zd in enumerate(dicts)]
+        comps = [functools.partial(zstd_compress, zd=zd) for zd in dicts]
 
-    plane_blocks, plane_sizes = [], []
-    for packed, _ in planes_packed:
-        sizes, blobs = compress_blocks(packed, comp)
-        plane_blocks.append(blobs)
-        plane_sizes.append(sizes)
+    plane_sizes, plane_blocks = [[] for _ in range(16)], [[] for _ in range(16)]
+    task = lambda b: compress_blocks(planes[b], comps[b])
+    # single‑block planes (64 B at the default batch) compress faster than a
+    # thread handoff; fan out only when planes span several blocks
+    results = POOL.map(task, coded) if planes.shape[1] > BLOCK_BYTES else map(task, coded)
+    for b, (sizes, blobs) in zip(coded, results):
+        plane_sizes[b], plane_blocks[b] = sizes, blobs
+
+    plane_cbytes     = [sum(sizes) for sizes in plane_sizes]
+    # block sizes as raw little‑endian SIZE_DTYPE; the header splits them
+    # per plane by plane_block_counts
+    plane_size_bytes = [np.asarray(sizes,SIZE_DTYPE).tobytes() for sizes in plane_sizes]
 
     comp_ms = (time.time()-t0)*1000
     now = time.time()
     with cache_lock:
         batch_cache.append(Batch(now-BATCH_SAMPLES/SAMPLE_HZ, now,
                                  BATCH_SAMPLES, plane_blocks,
-                                 plane_sizes, comp_ms))
+                                 plane_sizes, comp_ms, dicts, const0, const1,
+                                 plane_cbytes, plane_size_bytes))
+    if COMP_ALGO=="zstd":
+        update_dicts(planes)
 
 # ---------- networking ---------------------------------------------------
+IOV_MAX = 1024                     # Linux limit on buffers per sendmsg
+
+def send_iov(conn, iov):
+    """Send a list of buffers as one stream without joining them first."""
+    iov = [memoryview(b) for b in iov if len(b)]
+    if not hasattr(conn, "sendmsg"):             # e.g. Windows
+        for part in iov: conn.sendall(part)
+        return
+    i = 0
+    while i < len(iov):
+        sent = conn.sendmsg(iov[i:i+IOV_MAX])
+        while sent:                              # skip fully‑sent buffers
+            if sent >= len(iov[i]):
+                sent -= len(iov[i]); i += 1
+            else:
+                iov[i] = iov[i][sent:]; sent = 0
+
+def recvall(conn, n):
+    buf = bytearray(n); mv = memoryview(buf); pos = 0
+    while pos < n:
+        got = conn.recv_into(mv[pos:])
+        if not got: raise ConnectionError("socket closed")
+        pos += got
+    return buf
+
 def handle_client(conn):
     try:
-        rlen = struct.unpack("!I", conn.recv(4))[0]
-        req  = json.loads(conn.recv(rlen).decode())
+        rlen = struct.unpack("!I", recvall(conn, 4))[0]
+        req  = json.loads(recvall(conn, rlen).decode())
         planes = choose_planes(req.get("planes",16))
         t0,t1  = req["from"], req["to"]
 
@@ -111,36 +290,65 @@ def handle_client(conn):
         if not segs:
             conn.close(); return
 
-        hdr = dict(algo=COMP_ALGO,dtype="fp16",planes=planes,
+        hdr = dict(algo=COMP_ALGO,dtype="fp16",planes=planes,block_bytes=BLOCK_BYTES,size_dtype=SIZE_DTYPE,session=SESSION,
                    sensor_names=SENSORS,sensors=NUM_SENSORS,segments=[])
 
-        payload, total_cbytes, total_bits = [], 0, 0
+        # zstd dict ids the client already holds (only valid for this process)
+        known = set(req.get("dicts",[])) if req.get("session")==SESSION else set()
+        pmask = sum(1<<p for p in planes)
+        payload, total_cbytes, total_bits, new_dicts = [], 0, 0, {}
+        # identical blobs (near‑constant planes repeat across batches) go out
+        # once; repeats become [blob no., earlier blob no.] refs.  bytes cache
+        # their hash, so keying on the blob itself costs one hash per blob.
+        seen, refs, dup_bytes = {}, [], 0
         for seg in segs:
             sinfo = dict(start=seg.start_ts,end=seg.end_ts,samples=seg.samples,
-                         plane_block_sizes=[],plane_block_ratios=[],plane_num_bits=[])
+                         plane_block_counts=[],plane_block_ratios=[],plane_num_bits=[],
+                         plane_dict_ids=[],const0=seg.const0&pmask,const1=seg.const1&pmask)
             for p in planes:
                 sizes = seg.plane_block_sizes[p]
                 blobs = seg.plane_blocks[p]
-                payload.extend(blobs)
-                cbytes = sum(sizes)
+                zd    = seg.plane_dicts[p]
+                did   = zd.dict_id() if zd is not None else 0
+                if did and did not in known:
+                    new_dicts[did] = zd.as_bytes()
+                sinfo["plane_dict_ids"].append(did)
+                for blob in blobs:
+                    k = len(payload) + len(refs)
+                    first = seen.setdefault((did, blob), k)
+                    if first == k:
+                        payload.append(blob)
+                    else:
+                        refs.append([k, first]); dup_bytes += len(blob)
+                cbytes = seg.plane_cbytes[p]
                 n_bits = seg.samples*NUM_SENSORS
                 raw_bytes = (n_bits+7)//8
-                sinfo["plane_block_sizes"].append(sizes)
-                sinfo["plane_block_ratios"].append(round(raw_bytes/cbytes,3))
+                sinfo["plane_block_counts"].append(len(sizes))
+                # constant planes send no bytes, so they have no ratio
+                const = (seg.const0|seg.const1)>>p & 1
+                sinfo["plane_block_ratios"].append(None if const else round(raw_bytes/cbytes,3))
                 sinfo["plane_num_bits"].append(n_bits)
                 total_cbytes += cbytes
+            sinfo["plane_block_sizes"] = b"".join(seg.plane_size_bytes[p] for p in planes)
             total_bits += seg.samples*NUM_SENSORS*16
             hdr["segments"].append(sinfo)
 
+        # dictionaries the client lacks lead the payload, before any blob
+        hdr["dicts"] = [[did, len(d)] for did, d in new_dicts.items()]
+        payload[:0] = new_dicts.values()
+        total_cbytes += sum(map(len, new_dicts.values())) - dup_bytes
+        hdr["refs"] = refs
+
         hdr["compression_info"] = dict(
-            compressed_bytes = total_cbytes,
-            compression_ratio= round((total_bits//8)/total_cbytes,3),
+            compressed_bytes = total_cbytes,            # bytes on the wire
+            deduped_bytes    = dup_bytes,
+            compression_ratio= round((total_bits//8)/max(total_cbytes,1),3),
             avg_compression_latency_ms = round(sum(s.comp_time_ms for s in segs)/len(segs),2)
         )
 
-        hbytes = json.dumps(hdr).encode()
-        frame  = struct.pack("!I",len(hbytes))+hbytes+b"".join(payload)
-        conn.sendall(struct.pack("!I",len(frame))); conn.sendall(frame)
+        hbytes = msgpack.packb(hdr, use_bin_type=True)
+        frame_len = 4 + len(hbytes) + sum(map(len, payload))
+        send_iov(conn, [struct.pack("!II",frame_len,len(hbytes)), hbytes, *payload])
         print(f"🛰  sent {len(segs)} batch(es)  ratio {hdr['compression_info']['compression_ratio']}×")
     finally: conn.close()
 
@@ -1,33 +1,40 @@
 #!/usr/bin/env python3
 """
 Streamlit dashboard for FP‑16 bit‑plane demo (4 KB blocks, bit‑level packing).
-• Fetches compressed segments, decompresses, unpacks bits,
-  concatenates per‑plane bits across segments, reconstructs FP16 values
+• Fetches compressed segments, decompresses into packed bit‑planes,
+  unpacks once per segment and repacks the bits into FP16 values
 • Shows live chart, overall + per‑plane ratios, latencies
 • Simulates bandwidth throttle & packet loss
 • CSV download (unique key each refresh)
 """
 import json, socket, struct, time, random
-from datetime import datetime, timedelta
 import numpy as np, pandas as pd
-import lz4.frame as lz4, zstandard as zstd
+import lz4.frame as lz4, lz4.block as lz4b, zstandard as zstd, msgpack
 import streamlit as st
 
 PI_HOST = ""      # ← your Pi IP
 PORT    = 50007
+MAX_ROWS = 1<<16  # history ring capacity (rows)
+
+# zstd decompressors, reused across blobs and refreshes; key 0 = no dictionary,
+# other keys are dict ids whose dictionaries the sender shipped once
+zstd_dctx = {0: zstd.ZstdDecompressor()}
+zstd_session = None   # sender process the cached dict ids belong to
 
 def recvall(sock,n):
-    buf=bytearray()
-    while len(buf)<n:
-        chunk=sock.recv(n-len(buf))
-        if not chunk: raise ConnectionError("socket closed")
-        buf.extend(chunk)
+    buf=bytearray(n); mv=memoryview(buf); pos=0   # allocate once, fill in place
+    while pos<n:
+        got=sock.recv_into(mv[pos:])
+        if not got: raise ConnectionError("socket closed")
+        pos+=got
     return buf
 
 # ---------- fetch & reconstruct -----------------------------------------
 def fetch(seconds_back, planes_req, algo):
+    global zstd_session
     now=time.time()
-    req=dict(from_=now-seconds_back, to=now, planes=planes_req, algo=algo)
+    req=dict(from_=now-seconds_back, to=now, planes=planes_req, algo=algo,
+             dicts=[d for d in zstd_dctx if d], session=zstd_session)
     rb=json.dumps(req).replace("from_","from").encode()
 
     t0=time.time()
@@ -37,32 +44,58 @@ def fetch(seconds_back, planes_req, algo):
         frame=recvall(s,frame_len)
     net_ms=(time.time()-t0)*1000
 
-    hlen=struct.unpack("!I",frame[:4])[0]
-    hdr=json.loads(frame[4:4+hlen])
-    mv=memoryview(frame[4+hlen:])
+    fmv=memoryview(frame)
+    hlen=struct.unpack_from("!I",fmv)[0]
+    hdr=msgpack.unpackb(fmv[4:4+hlen],raw=False)
+    for seg in hdr["segments"]:      # size blob → per‑plane lists
+        flat=np.frombuffer(seg["plane_block_sizes"],hdr["size_dtype"]).tolist()
+        ends=np.cumsum(seg["plane_block_counts"]).tolist()
+        seg["plane_block_sizes"]=[flat[e-c:e] for c,e in zip(seg["plane_block_counts"],ends)]
+    mv=fmv[4+hlen:]                     # zero‑copy view; slices don't copy
+
+    # keep only dicts this response uses (none, if the sender restarted)
+    live={d for seg in hdr["segments"] for d in seg["plane_dict_ids"]} \
+         if hdr["session"]==zstd_session else set()
+    for did in [d for d in zstd_dctx if d and d not in live]: del zstd_dctx[did]
+    zstd_session=hdr["session"]
+    off=0
+    for did,n in hdr.get("dicts",[]):
+        zd=zstd.ZstdCompressionDict(bytes(mv[off:off+n])); off+=n
+        zstd_dctx[did]=zstd.ZstdDecompressor(dict_data=zd)
 
-    decomp = (lambda b: np.frombuffer(lz4.decompress(b),dtype=np.uint8)) \
-             if hdr["algo"]=="lz4" else \
-             (lambda b: np.frombuffer(zstd.ZstdDecompressor().decompress(b),dtype=np.uint8))
+    decomp = {
+        "lz4":  lambda b,did,u: lz4.decompress(b),
+        "lz4b": lambda b,did,u: lz4b.decompress(b,uncompressed_size=u),
+        "zstd": lambda b,did,u: zstd_dctx[did].decompress(b),
+    }[hdr["algo"]]
+    blk=hdr["block_bytes"]
 
     sensors=hdr["sensors"]; planes=hdr["planes"]
-    groups={p:[] for p in planes}
-    off=0
+    refs=dict(hdr["refs"])   # blob no. → earlier identical blob no. (not resent)
+    srcs=[]                  # every blob in send order, as payload views
+    seg_vals=[]
     for seg in hdr["segments"]:
+        n_vals=seg["samples"]*sensors
+        acc=np.zeros((16,(n_vals+7)//8),np.uint8)  # packed planes; unsent stay 0
+        amv=memoryview(acc).cast("B"); row=acc.shape[1]
         for i,p in enumerate(planes):
-            n_bits=seg["plane_num_bits"][i]
-            bits=[]
-            for sz in seg["plane_block_sizes"][i]:
-                bits.append(decomp(mv[off:off+sz])); off+=sz
-            bits=np.unpackbits(np.concatenate(bits))[:n_bits]
-            groups[p].append(bits)
-
-    total_vals=sum(seg["samples"]*sensors for seg in hdr["segments"])
-    vals=np.zeros(total_vals,dtype=np.uint16)
-    for p,bits_list in groups.items():
-        bits=np.concatenate(bits_list)
-        vals|=(bits.astype(np.uint16)<<p)
-    fp=vals.view(np.float16).astype(np.float32).reshape(-1,sensors)
+            if seg["const1"]>>p & 1: acc[p]=0xFF   # constant planes: no blocks
+            did=seg["plane_dict_ids"][i]
+            raw=(seg["plane_num_bits"][i]+7)//8
+            for j,sz in enumerate(seg["plane_block_sizes"][i]):
+                u=min(blk,raw-j*blk); w=p*row+j*blk   # straight into row p
+                if len(srcs) in refs: src=srcs[refs[len(srcs)]]
+                else: src=mv[off:off+sz]; off+=sz
+                srcs.append(src)
+                amv[w:w+u]=decomp(src,did,u)
+        # one unpack, then repack across planes: row 0 = low byte, row 1 = high
+        bits=np.unpackbits(acc,axis=1,count=n_vals)
+        lohi=np.packbits(bits,axis=0,bitorder="little")
+        u16=np.ascontiguousarray(lohi.T).view("<u2").ravel()
+        seg_vals.append(u16.reshape(sensors,-1).T)  # sensor‑major → (samples, sensors)
+
+    vals=np.concatenate(seg_vals)
+    fp=vals.view(np.float16).astype(np.float32)
     return fp,hdr,net_ms
 
 # ---------- Streamlit UI -------------------------------------------------
@@ -72,7 +105,7 @@ st.title("FP‑16 Bit‑plane Compression Demo (4 KB blocks, bit‑packed)")
 with st.sidebar:
     seconds = st.slider("History window (s)",5,300,60,5)
     planes  = st.slider("Requested bit‑planes",7,16,12)
-    codec   = st.selectbox("Codec",["lz4","zstd"],0)
+    codec   = st.selectbox("Codec",["lz4","lz4b","zstd"],0)
     kbps    = st.slider("Bandwidth throttle (kB/s)",5,1000,500)
     loss    = st.slider("Packet‑loss (%)",0,100,0)
     period  = st.slider("Auto‑refresh (s)",1,30,3)
@@ -82,13 +115,21 @@ with st.sidebar:
 
 chart = st.empty(); stats = st.empty(); table = st.expander("Per‑plane",False)
 hist  = pd.DataFrame()
+ring  = None; head = 0    # fixed ring: col 0 = unix time, then one per sensor
 
 def push(arr,names):
-    global hist
-    now=datetime.utcnow(); n=len(arr)
-    times=[now-timedelta(seconds=(n-i-1)*seconds/n) for i in range(n)]
-    df=pd.DataFrame(arr,index=pd.to_datetime(times),columns=names)
-    hist=pd.concat([hist,df]).last(f"{seconds}s")
+    global hist, ring, head
+    if ring is None or ring.shape[1]!=len(names)+1:
+        ring=np.full((MAX_ROWS,len(names)+1),np.nan); head=0
+    arr=arr[-MAX_ROWS:]; n=len(arr); now=time.time()
+    slots=(head+np.arange(n))%MAX_ROWS
+    ring[slots,0]=now-(n-1-np.arange(n))*seconds/n
+    ring[slots,1:]=arr
+    head=(head+n)%MAX_ROWS
+    # DataFrame only for rendering: rows in the window, oldest first
+    sel=np.flatnonzero(ring[:,0]>now-seconds)     # empty (NaN) slots never match
+    sel=sel[np.argsort((sel-head)%MAX_ROWS)]
+    hist=pd.DataFrame(ring[sel,1:],index=pd.to_datetime(ring[sel,0],unit="s"),columns=names)
 
 def csv_dl():
     csv_box.empty()
@@ -118,7 +159,8 @@ f"""
                 "Plane": hdr["planes"],
                 "#Blocks":[len(x) for x in seg0["plane_block_sizes"]],
                 "CompBytes":[sum(x) for x in seg0["plane_block_sizes"]],
-                "Ratio": seg0["plane_block_ratios"]
+                "Ratio":[np.nan if r is None else r for r in seg0["plane_block_ratios"]],
+                "Const":[r is None for r in seg0["plane_block_ratios"]]
             }))
             csv_dl()
         except Exception as e: